@@ -0,0 +1,529 @@
+"""
+Google Sheets access, caching and search shared by the Telegram bots
+"""
+
+import os
+import asyncio
+from array import array
+import bisect
+import functools
+import itertools
+import json
+import logging
+import pickle
+import re
+import sys
+import threading
+import time
+from google.oauth2.credentials import Credentials
+from google_auth_oauthlib.flow import InstalledAppFlow
+from google.auth.transport.requests import Request
+import aiohttp
+from aiolimiter import AsyncLimiter
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_random_exponential
+import pandas as pd
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Sheets REST endpoint for every sheet read
+SHEETS_API_URL = 'https://sheets.googleapis.com/v4/spreadsheets'
+
+def _is_transient(error):
+    """Whether a failed Sheets request is worth retrying: quota, server or network errors"""
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status == 429 or error.status >= 500
+    return isinstance(error, (aiohttp.ClientConnectionError, asyncio.TimeoutError))
+
+# Words used to index the sheet for search
+WORD_PATTERN = re.compile(r'\w+')
+
+# Optional: Hyperscan speeds up multi-term (AND) searches
+try:
+    import hyperscan
+except ImportError:
+    hyperscan = None
+
+class SheetSnapshot:
+    """A fetched sheet range together with the views derived from it for search"""
+    
+    def __init__(self, df, corpus, line_offsets, postings, vocabulary, summary):
+        self.df = df
+        # Lowercase rows as one NUL-separated UTF-8 buffer; row i spans
+        # corpus[line_offsets[i]:line_offsets[i + 1] - 1]
+        self.corpus = corpus
+        self.line_offsets = line_offsets
+        # Rows for each word as one CSR pair (word start offsets, row ids),
+        # numbered like the vocabulary; None when the frame is not indexed
+        self.postings = postings
+        # Indexed words joined by newlines, searched in one pass per query word;
+        # a tuple of (text, word start offsets)
+        self.vocabulary = vocabulary
+        self.summary = summary
+        self.fetched_at = time.monotonic()
+
+class SheetsBackend:
+    def __init__(self):
+        self.spreadsheet_id = os.getenv('GOOGLE_SHEET_ID')
+        self.scopes = ['https://www.googleapis.com/auth/spreadsheets.readonly']
+        self.credentials = None
+        # Held while logging in or renewing the token: concurrent first reads
+        # would each start the browser flow on port 8080
+        self._auth_lock = threading.RLock()
+        self._session = None
+        # Stay under the Sheets quota of 100 reads per 100 seconds
+        self._sheets_limiter = AsyncLimiter(90, 100)
+        
+        # In-memory cache of sheet reads: (spreadsheet_id, ranges) -> SheetSnapshot.
+        # A range always names its sheet, so it also stands in for the sheet name
+        self._cache = {}
+        self._cache_ttl = 60  # seconds
+        # Sheet fetches in progress, keyed like the cache
+        self._inflight = {}
+        
+        # Formatted search replies, keyed by (snapshot, query)
+        self._memo_search = functools.lru_cache(maxsize=256)(self._search_snapshot)
+        # Hyperscan databases, compiled once per set of AND terms
+        self._compiled_terms = functools.lru_cache(maxsize=64)(self._compile_terms)
+    
+    def authenticate_google_sheets(self):
+        """Authenticate with Google Sheets API"""
+        try:
+            creds = None
+            # The file token.json stores the user's access and refresh tokens.
+            if os.path.exists('token.json'):
+                creds = Credentials.from_authorized_user_file('token.json', self.scopes)
+            elif os.path.exists('token.pickle'):
+                # One-time migration from the pickled token of the older scripts
+                with open('token.pickle', 'rb') as token:
+                    creds = pickle.load(token)
+                with open('token.json', 'w') as token:
+                    token.write(creds.to_json())
+                logger.info("Migrated token.pickle to token.json")
+            
+            # If there are no (valid) credentials available, let the user log in.
+            if not creds or not creds.valid:
+                if creds and creds.expired and creds.refresh_token:
+                    creds.refresh(Request())
+                else:
+                    if not os.path.exists('credentials.json'):
+                        raise FileNotFoundError("credentials.json not found. Please download it from Google Cloud Console.")
+                    flow = InstalledAppFlow.from_client_secrets_file(
+                        'credentials.json', self.scopes)
+                    creds = flow.run_local_server(port=8080, open_browser=True)
+                # Save the credentials for the next run
+                with open('token.json', 'w') as token:
+                    token.write(creds.to_json())
+            
+            self.credentials = creds
+            logger.info("Google Sheets authentication successful")
+        except Exception as e:
+            logger.error(f"Google Sheets authentication failed: {e}")
+            raise
+    
+    def refresh_credentials(self):
+        """Refresh an expired access token in place, without the browser login"""
+        with self._auth_lock:
+            creds = self.credentials
+            if creds and creds.expired and creds.refresh_token:
+                creds.refresh(Request())
+                with open('token.json', 'w') as token:
+                    token.write(creds.to_json())
+                logger.info("Google Sheets credentials refreshed")
+    
+    def ensure_credentials(self):
+        """Log in on first use, else renew an expired token; one thread at a time"""
+        with self._auth_lock:
+            if not self.credentials:
+                self.authenticate_google_sheets()
+            elif not self.credentials.valid:
+                self.refresh_credentials()
+    
+    async def aget_sheet_data(self, sheet_name='Sheet1', range_name=None):
+        """Retrieve data from a handler over aiohttp, without blocking the event loop"""
+        try:
+            ranges = (range_name or f'{sheet_name}!A:ZZ',)
+            
+            snapshot = self._fresh_snapshot(ranges)
+            if snapshot is not None:
+                return snapshot.df
+            
+            return await asyncio.shield(self._start_fetch(ranges))
+        
+        except Exception as e:
+            logger.error(f"Error retrieving data from Google Sheets: {e}")
+            # During an outage the last good read beats telling users there is no data
+            stale = self._cache.get((self.spreadsheet_id, ranges))
+            if stale is not None:
+                logger.warning(f"Serving sheet data from {time.monotonic() - stale.fetched_at:.0f}s ago")
+                return stale.df
+            return pd.DataFrame()
+    
+    def _start_fetch(self, ranges):
+        """The fetch in progress for these ranges, starting one if there is none"""
+        # The first miss on a range starts the fetch; later misses await the same one
+        key = (self.spreadsheet_id, ranges)
+        inflight = self._inflight.get(key)
+        if inflight is None:
+            inflight = asyncio.ensure_future(self._afetch_sheet_data(ranges))
+            self._inflight[key] = inflight
+            inflight.add_done_callback(functools.partial(self._clear_inflight, key))
+        return inflight
+    
+    async def _afetch_sheet_data(self, ranges):
+        """Fetch a range from the Sheets REST API with a bearer token and cache it"""
+        if not self.credentials or not self.credentials.valid:
+            await asyncio.to_thread(self.ensure_credentials)
+        
+        if self._session is None:
+            await self.open_session()
+        
+        body = await self._request_values(ranges)
+        # Parsing the response and building the frame and search index is CPU
+        # work that would stall every other handler; do it on a worker thread
+        return await asyncio.to_thread(lambda: self._store_values(ranges, json.loads(body)))
+    
+    @retry(retry=retry_if_exception(_is_transient), stop=stop_after_attempt(4),
+           wait=wait_random_exponential(multiplier=0.3, max=5), reraise=True)
+    async def _request_values(self, ranges):
+        """Call values:batchGet over aiohttp and return the raw body, backing off on transient failures"""
+        async with self._sheets_limiter, self._session.get(
+            f'{SHEETS_API_URL}/{self.spreadsheet_id}/values:batchGet',
+            headers={'Authorization': f'Bearer {self.credentials.token}'},
+            # Cells come back as displayed ("$1,234.50", "50%") so searches match what users see;
+            # fields skips range and dimension metadata in the response
+            params=[('ranges', range_name) for range_name in ranges] + [
+                ('valueRenderOption', 'FORMATTED_VALUE'),
+                ('fields', 'valueRanges(values)')
+            ]
+        ) as response:
+            response.raise_for_status()
+            return await response.read()
+    
+    async def open_session(self):
+        """Create the aiohttp session shared by every Sheets read"""
+        if self._session is None:
+            # Keep-alive connections are reused across reads instead of a new TLS handshake each
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=32, keepalive_timeout=75),
+                timeout=aiohttp.ClientTimeout(total=30)
+            )
+    
+    async def close_session(self):
+        """Close the shared aiohttp session"""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+    
+    def _clear_inflight(self, key, future):
+        """Forget a finished in-flight fetch"""
+        self._inflight.pop(key, None)
+    
+    async def warm_cache(self):
+        """Authenticate and load the sheet before the first user asks for it"""
+        try:
+            df = await self.aget_sheet_data()
+            logger.info(f"Cache warmed with {len(df)} rows")
+        except Exception as e:
+            logger.error(f"Error warming the sheet cache: {e}")
+    
+    def schedule_refresh(self, job_queue):
+        """Load the sheet as the bot starts, then keep re-reading it so users always hit the cache"""
+        job_queue.run_once(lambda context: self.warm_cache(), when=0)
+        # Refresh at half the TTL: fetched_at is stamped when a fetch lands, so
+        # a refresh slower than the last one still finishes before the data expires
+        interval = self._cache_ttl / 2
+        job_queue.run_repeating(lambda context: self.refresh_cache(), interval=interval, first=interval)
+    
+    async def refresh_cache(self, range_name='Sheet1!A:ZZ'):
+        """Re-read the sheet in the background; readers keep the old data until it lands"""
+        try:
+            # Same fetch as the handlers use, so a refresh and a cache miss share one request
+            await asyncio.shield(self._start_fetch((range_name,)))
+        except Exception as e:
+            logger.error(f"Error refreshing data from Google Sheets: {e}")
+    
+    def _fresh_snapshot(self, ranges):
+        """The cached snapshot if it is fresh and covers these ranges, else None"""
+        snapshot = self._cache.get((self.spreadsheet_id, ranges))
+        if snapshot is not None and time.monotonic() - snapshot.fetched_at < self._cache_ttl:
+            return snapshot
+        return None
+    
+    def _snapshot_for(self, df):
+        """The cached snapshot a DataFrame came from, or None"""
+        for snapshot in list(self._cache.values()):
+            if snapshot.df is df:
+                return snapshot
+        return None
+    
+    def _store_values(self, ranges, result):
+        """Build the DataFrame and search views for a batchGet response and cache them"""
+        value_ranges = result.get('valueRanges', [])
+        values = value_ranges[0].get('values', []) if value_ranges else []
+        
+        if not values:
+            logger.warning('No data found in the sheet')
+            df = pd.DataFrame()
+        else:
+            # Convert to DataFrame; Arrow-backed strings are compact and
+            # searched with C-level string kernels
+            df = pd.DataFrame(values[1:], columns=values[0], dtype=object)
+            df = df.astype('string[pyarrow]')
+            logger.info(f"Retrieved {len(df)} rows from Google Sheets")
+        
+        # Search runs over strings built straight from the API rows
+        self._cache[(self.spreadsheet_id, ranges)] = self._build_snapshot(df, values[1:])
+        self._evict_expired()
+        self._memo_search.cache_clear()
+        return df
+    
+    def _evict_expired(self):
+        """Drop expired snapshots, e.g. of ranges read once and never again"""
+        now = time.monotonic()
+        for key, snapshot in list(self._cache.items()):
+            if now - snapshot.fetched_at >= self._cache_ttl:
+                self._cache.pop(key, None)
+    
+    def clear_cache(self):
+        """Drop cached sheet data so the next read goes to Google Sheets"""
+        self._cache.clear()
+        self._memo_search.cache_clear()
+    
+    def _build_snapshot(self, df, rows, index=True):
+        """Derive the search corpus, word index and summary for a frame"""
+        search_lines = ['\x1f'.join('' if value is None else str(value) for value in row).lower()
+                        for row in rows]
+        corpus, line_offsets = self._build_corpus(search_lines)
+        words, postings = self._build_postings(search_lines) if index else ([], None)
+        vocabulary = self._pack(words, '\n')
+        # One-off snapshots for frames outside the cache only need the corpus
+        summary = self._build_summary(df) if index else None
+        return SheetSnapshot(df, corpus, line_offsets, postings, vocabulary, summary)
+    
+    def _build_corpus(self, search_lines):
+        """Pack the row strings into one NUL-separated buffer with row start offsets"""
+        return self._pack([line.encode() for line in search_lines], b'\0')
+    
+    def _pack(self, parts, separator):
+        """Join parts with a one-character separator, recording where each part starts"""
+        # Machine integers: one boxed int per word or row adds up on large sheets
+        offsets = array('q')
+        position = 0
+        for part in parts:
+            offsets.append(position)
+            position += len(part) + 1
+        # Sentinel so every part ends at offsets[i + 1] - 1
+        offsets.append(position)
+        return separator.join(parts), offsets
+    
+    def _build_postings(self, search_lines):
+        """Index the rows containing each word; returns the words and a CSR (offsets, rows) pair"""
+        # One (word id, row) pair per distinct word in a row, kept in flat
+        # arrays: a separate array per word costs far more than the corpus
+        # on sheets full of IDs, emails and phone numbers
+        word_ids = {}
+        pair_words = array('q')
+        pair_rows = array('q')
+        for row_id, text in enumerate(search_lines):
+            row_words = set(WORD_PATTERN.findall(text))
+            pair_words.extend(word_ids.setdefault(word, len(word_ids)) for word in row_words)
+            pair_rows.extend(itertools.repeat(row_id, len(row_words)))
+        
+        pair_words = np.frombuffer(pair_words, dtype=np.int64)
+        # A stable sort groups the pairs by word and keeps each word's rows ascending
+        order = np.argsort(pair_words, kind='stable')
+        rows = np.frombuffer(pair_rows, dtype=np.int64)[order].astype(np.int32)
+        offsets = np.zeros(len(word_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(pair_words, minlength=len(word_ids)), out=offsets[1:])
+        return list(word_ids), (offsets, rows)
+    
+    def _rows_containing(self, term, snapshot, candidates=None):
+        """Row positions whose text contains the term, scanning the corpus with bytes.find"""
+        corpus, line_offsets = snapshot.corpus, snapshot.line_offsets
+        needle = term.encode()
+        if candidates is not None:
+            return [row for row in candidates
+                    if corpus.find(needle, line_offsets[row], line_offsets[row + 1] - 1) != -1]
+        
+        rows = []
+        position = corpus.find(needle)
+        while position != -1:
+            row = bisect.bisect_right(line_offsets, position) - 1
+            rows.append(row)
+            # Resume at the next row; one hit per row is enough
+            position = corpus.find(needle, line_offsets[row + 1])
+        return rows
+    
+    def _compile_terms(self, terms):
+        """Compile a tuple of terms into a Hyperscan block-mode database"""
+        database = hyperscan.Database(mode=hyperscan.HS_MODE_BLOCK)
+        database.compile(
+            # Hex-escape every byte so the terms match literally
+            expressions=[''.join(f'\\x{byte:02x}' for byte in term.encode()).encode()
+                         for term in terms],
+            ids=list(range(len(terms))),
+            elements=len(terms),
+            flags=[0] * len(terms)
+        )
+        return database
+    
+    def _scan_terms(self, terms, snapshot):
+        """Rows containing every term, found in one Hyperscan pass"""
+        database = self._compiled_terms(tuple(terms))
+        line_offsets = snapshot.line_offsets
+        hits = [set() for _ in terms]
+        def on_match(term_id, start, end, flags, context):
+            hits[term_id].add(bisect.bisect_right(line_offsets, end - 1) - 1)
+        
+        # Searches run on several worker threads, so each scan gets its own scratch
+        database.scan(snapshot.corpus, match_event_handler=on_match,
+                      scratch=hyperscan.Scratch(database))
+        return sorted(set.intersection(*hits))
+    
+    def _words_containing(self, query_word, snapshot):
+        """Ids of the indexed words that contain query_word, found with str.find over the joined vocabulary"""
+        text, offsets = snapshot.vocabulary
+        found = []
+        position = text.find(query_word)
+        while position != -1:
+            word_id = bisect.bisect_right(offsets, position) - 1
+            found.append(word_id)
+            # Resume at the next word; one hit per word is enough
+            position = text.find(query_word, offsets[word_id + 1])
+        return found
+    
+    def _index_candidates(self, query, snapshot):
+        """Row positions that may contain the query, or None to scan every row"""
+        words = set(WORD_PATTERN.findall(query))
+        if not words or snapshot.postings is None:
+            return None
+        
+        offsets, rows = snapshot.postings
+        candidates = None
+        for query_word in words:
+            # A query word may be part of a longer word in the sheet
+            hits = [rows[offsets[word_id]:offsets[word_id + 1]]
+                    for word_id in self._words_containing(query_word, snapshot)]
+            if not hits:
+                return np.empty(0, dtype=np.int32)
+            word_rows = np.unique(np.concatenate(hits))
+            candidates = word_rows if candidates is None else np.intersect1d(candidates, word_rows)
+        return candidates
+    
+    def search_data(self, query, df):
+        """Search for data based on query"""
+        if df.empty:
+            return "No data available"
+        
+        # Repeated queries against the cached sheet reuse the formatted reply
+        snapshot = self._snapshot_for(df)
+        if snapshot is not None:
+            reply = self._memo_search(snapshot, query)
+            # A search that finished after a reload has just memoized the replaced
+            # snapshot; drop it so the old frame and index are not kept alive
+            if self._snapshot_for(df) is not snapshot:
+                self._memo_search.cache_clear()
+            return reply
+        rows = df.fillna('').astype(str).values.tolist()
+        return self._search_snapshot(self._build_snapshot(df, rows, index=False), query)
+    
+    def _search_snapshot(self, snapshot, query):
+        """Find the rows matching the query and format them"""
+        # "term AND term" needs every term in the row; anything else is one term
+        terms = [term.strip().lower() for term in query.split(' AND ')]
+        terms = [term for term in terms if term] if len(terms) > 1 else []
+        terms = terms or [query.lower()]
+        
+        # The index answers terms made only of word characters exactly.
+        # Other terms, or any term without an index, are checked in the text
+        # directly: their short word fragments would pull in most of the index
+        exact = [term for term in terms if snapshot.postings is not None and WORD_PATTERN.fullmatch(term)]
+        unverified = [term for term in terms if term not in exact]
+        
+        candidates = None
+        for term in exact:
+            term_rows = self._index_candidates(term, snapshot)
+            candidates = term_rows if candidates is None else np.intersect1d(candidates, term_rows)
+        
+        if len(unverified) > 1 and hyperscan is not None:
+            matches = self._scan_terms(unverified, snapshot)
+            if candidates is not None:
+                matches = np.intersect1d(matches, candidates).tolist()
+        else:
+            # Without an index hint the first term scans the whole corpus
+            if candidates is None:
+                matches = self._rows_containing(unverified[0], snapshot)
+                unverified = unverified[1:]
+            else:
+                matches = candidates.tolist()
+            for term in unverified:
+                matches = self._rows_containing(term, snapshot, matches)
+        
+        if not matches:
+            return f"No results found for '{query}'"
+        
+        # Only the rows that get shown are sliced out of the frame
+        results = snapshot.df.iloc[matches[:5]]
+        
+        # Format results
+        if len(matches) == 1:
+            return self.format_single_result(results.iloc[0])
+        else:
+            return self.format_multiple_results(results, len(matches))
+    
+    def format_single_result(self, row):
+        """Format a single result row"""
+        parts = ["Found Result:\n\n"]
+        fields = self._non_empty_fields(row.index, row.to_numpy(dtype=object, na_value=None))
+        parts.extend(f"{col}: {value}\n" for col, value in fields)
+        return ''.join(parts)
+    
+    def format_multiple_results(self, results, total=None):
+        """Format multiple results; total counts matches beyond the rows passed in"""
+        if total is None:
+            total = len(results)
+        parts = [f"Found {total} results:\n\n"]
+        
+        # Show first 5 results; missing cells come out as None in one conversion
+        rows = results.head(5).to_numpy(dtype=object, na_value=None).tolist()
+        # Column names are looked up once and shared by every row
+        columns = tuple(sys.intern(str(col)) for col in results.columns)
+        for i, values in enumerate(rows):
+            parts.append(f"Result {i+1}:\n")
+            parts.extend(f"  {col}: {value}\n" for col, value in self._non_empty_fields(columns, values))
+            parts.append("\n")
+        
+        if total > 5:
+            parts.append(f"... and {total - 5} more results")
+        
+        return ''.join(parts)
+    
+    def _non_empty_fields(self, columns, values):
+        """(column, value) pairs for the cells that have something to show"""
+        return [(col, value) for col, value in zip(columns, values)
+                if value is not None and str(value).strip()]
+    
+    def get_summary_stats(self, df):
+        """Get summary statistics of the data"""
+        snapshot = self._snapshot_for(df)
+        if snapshot is not None:
+            return snapshot.summary
+        return self._build_summary(df)
+    
+    def _build_summary(self, df):
+        """Render the summary text for a DataFrame"""
+        if df.empty:
+            return "No data available for summary"
+        
+        parts = [
+            "Data Summary:\n\n",
+            f"Total Records: {len(df)}\n",
+            f"Total Columns: {len(df.columns)}\n\n",
+            "Columns:\n"
+        ]
+        # Count non-empty cells for every column in one pass
+        parts.extend(f"  • {col} ({non_null_count} values)\n"
+                     for col, non_null_count in df.notna().sum().items())
+        
+        return ''.join(parts)
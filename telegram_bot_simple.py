@@ -1,15 +1,11 @@
 import os
+import asyncio
 import logging
 from telegram import Update
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
-import pandas as pd
 from dotenv import load_dotenv
-import json
-import pickle
+from sheets_backend import SheetsBackend
+from telegram_utils import run_bot, safe_reply
 
 # Load environment variables
 load_dotenv()
@@ -21,136 +17,10 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-class TelegramBotWithSheets:
+class TelegramBotWithSheets(SheetsBackend):
     def __init__(self):
+        super().__init__()
         self.bot_token = os.getenv('TELEGRAM_BOT_TOKEN')
-        self.spreadsheet_id = os.getenv('GOOGLE_SHEET_ID')
-        self.scopes = ['https://www.googleapis.com/auth/spreadsheets.readonly']
-        self.credentials = None
-        self.service = None
-        
-    def authenticate_google_sheets(self):
-        """Authenticate with Google Sheets API"""
-        try:
-            creds = None
-            # The file token.pickle stores the user's access and refresh tokens.
-            if os.path.exists('token.pickle'):
-                with open('token.pickle', 'rb') as token:
-                    creds = pickle.load(token)
-            
-            # If there are no (valid) credentials available, let the user log in.
-            if not creds or not creds.valid:
-                if creds and creds.expired and creds.refresh_token:
-                    creds.refresh(Request())
-                else:
-                    if not os.path.exists('credentials.json'):
-                        raise FileNotFoundError("credentials.json not found. Please download it from Google Cloud Console.")
-                    flow = InstalledAppFlow.from_client_secrets_file(
-                        'credentials.json', self.scopes)
-                    creds = flow.run_local_server(port=8080, open_browser=True)
-                # Save the credentials for the next run
-                with open('token.pickle', 'wb') as token:
-                    pickle.dump(creds, token)
-            
-            self.credentials = creds
-            self.service = build('sheets', 'v4', credentials=creds)
-            logger.info("Google Sheets authentication successful")
-        except Exception as e:
-            logger.error(f"Google Sheets authentication failed: {e}")
-            raise
-    
-    def get_sheet_data(self, sheet_name='Sheet1', range_name=None):
-        """Retrieve data from Google Sheets"""
-        try:
-            if not self.service:
-                self.authenticate_google_sheets()
-            
-            if range_name is None:
-                range_name = f'{sheet_name}!A:Z'
-            
-            # Call the Sheets API
-            sheet = self.service.spreadsheets()
-            result = sheet.values().get(
-                spreadsheetId=self.spreadsheet_id,
-                range=range_name
-            ).execute()
-            
-            values = result.get('values', [])
-            
-            if not values:
-                logger.warning('No data found in the sheet')
-                return pd.DataFrame()
-            
-            # Convert to DataFrame
-            df = pd.DataFrame(values[1:], columns=values[0])
-            logger.info(f"Retrieved {len(df)} rows from Google Sheets")
-            return df
-            
-        except Exception as e:
-            logger.error(f"Error retrieving data from Google Sheets: {e}")
-            return pd.DataFrame()
-    
-    def search_data(self, query, df):
-        """Search for data based on query"""
-        if df.empty:
-            return "No data available"
-        
-        # Convert all columns to string for searching
-        df_str = df.astype(str)
-        
-        # Search across all columns
-        mask = df_str.apply(lambda x: x.str.contains(query, case=False, na=False)).any(axis=1)
-        results = df[mask]
-        
-        if results.empty:
-            return f"No results found for '{query}'"
-        
-        # Format results
-        if len(results) == 1:
-            return self.format_single_result(results.iloc[0])
-        else:
-            return self.format_multiple_results(results)
-    
-    def format_single_result(self, row):
-        """Format a single result row"""
-        result = "Found Result:\n\n"
-        for col, value in row.items():
-            if pd.notna(value) and str(value).strip():
-                result += f"{col}: {value}\n"
-        return result
-    
-    def format_multiple_results(self, results):
-        """Format multiple results"""
-        result = f"Found {len(results)} results:\n\n"
-        
-        # Show first 5 results
-        for i, (_, row) in enumerate(results.head(5).iterrows()):
-            result += f"Result {i+1}:\n"
-            for col, value in row.items():
-                if pd.notna(value) and str(value).strip():
-                    result += f"  {col}: {value}\n"
-            result += "\n"
-        
-        if len(results) > 5:
-            result += f"... and {len(results) - 5} more results"
-        
-        return result
-    
-    def get_summary_stats(self, df):
-        """Get summary statistics of the data"""
-        if df.empty:
-            return "No data available for summary"
-        
-        summary = "Data Summary:\n\n"
-        summary += f"Total Records: {len(df)}\n"
-        summary += f"Total Columns: {len(df.columns)}\n\n"
-        
-        summary += "Columns:\n"
-        for col in df.columns:
-            non_null_count = df[col].notna().sum()
-            summary += f"  • {col} ({non_null_count} values)\n"
-        
-        return summary
 
 # Initialize bot
 bot = TelegramBotWithSheets()
@@ -174,7 +44,7 @@ Just send me a question or search term, and I'll look it up in your Google Sheet
 
 Example: "Find all products with price > 100"
     """
-    await update.message.reply_text(welcome_message)
+    await safe_reply(update, welcome_message)
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Send a message when the command /help is issued."""
@@ -193,50 +63,50 @@ Search Examples:
 • "customers from New York"
 • "orders from last month"
 • "John Smith"
+• "New York AND 2024"
 
 Tips:
 • You can ask questions in natural language
 • Search is case-insensitive
+• Join terms with AND to find rows containing all of them
 • I'll show you the most relevant results
     """
-    await update.message.reply_text(help_text)
+    await safe_reply(update, help_text)
 
 async def summary(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Get summary of the data"""
     try:
-        df = bot.get_sheet_data()
+        df = await bot.aget_sheet_data()
         summary_text = bot.get_summary_stats(df)
-        await update.message.reply_text(summary_text)
+        await safe_reply(update, summary_text)
     except Exception as e:
-        await update.message.reply_text(f"Error getting summary: {str(e)}")
+        await safe_reply(update, f"Error getting summary: {str(e)}")
 
 async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /search command"""
     try:
         query = ' '.join(context.args) if context.args else ""
         if not query:
-            await update.message.reply_text("Please provide a search query. Example: /search products")
+            await safe_reply(update, "Please provide a search query. Example: /search products")
             return
         
-        df = bot.get_sheet_data()
-        results = bot.search_data(query, df)
-        await update.message.reply_text(results)
+        df = await bot.aget_sheet_data()
+        results = await asyncio.to_thread(bot.search_data, query, df)
+        await safe_reply(update, results)
     except Exception as e:
-        await update.message.reply_text(f"Error searching: {str(e)}")
+        await safe_reply(update, f"Error searching: {str(e)}")
 
 async def refresh(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Refresh data from Google Sheets"""
     try:
-        # Clear any cached credentials to force refresh
-        if os.path.exists('token.pickle'):
-            os.remove('token.pickle')
-        
-        bot.authenticate_google_sheets()
-        df = bot.get_sheet_data()
+        # Drop the cached sheet; renew the access token only if it has expired
+        bot.clear_cache()
+        await asyncio.to_thread(bot.refresh_credentials)
+        df = await bot.aget_sheet_data()
         
-        await update.message.reply_text(f"Data refreshed! Retrieved {len(df)} records from Google Sheets.")
+        await safe_reply(update, f"Data refreshed! Retrieved {len(df)} records from Google Sheets.")
     except Exception as e:
-        await update.message.reply_text(f"Error refreshing data: {str(e)}")
+        await safe_reply(update, f"Error refreshing data: {str(e)}")
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle regular text messages"""
@@ -245,19 +115,19 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.info(f"User query: {user_message}")
         
         # Get data from Google Sheets
-        df = bot.get_sheet_data()
+        df = await bot.aget_sheet_data()
         
         if df.empty:
-            await update.message.reply_text("No data available. Please check your Google Sheets configuration.")
+            await safe_reply(update, "No data available. Please check your Google Sheets configuration.")
             return
         
         # Search for the query
-        results = bot.search_data(user_message, df)
-        await update.message.reply_text(results)
+        results = await asyncio.to_thread(bot.search_data, user_message, df)
+        await safe_reply(update, results)
         
     except Exception as e:
         logger.error(f"Error handling message: {e}")
-        await update.message.reply_text(f"Sorry, I encountered an error: {str(e)}")
+        await safe_reply(update, f"Sorry, I encountered an error: {str(e)}")
 
 def main():
     """Start the bot."""
@@ -275,7 +145,14 @@ def main():
             return
         
         # Create the Application
-        application = Application.builder().token(bot.bot_token).build()
+        # One aiohttp session serves every Sheets read for the life of the bot
+        application = (
+            Application.builder()
+            .token(bot.bot_token)
+            .post_init(lambda application: bot.open_session())
+            .post_shutdown(lambda application: bot.close_session())
+            .build()
+        )
         
         # Add handlers
         application.add_handler(CommandHandler("start", start))
@@ -285,11 +162,14 @@ def main():
         application.add_handler(CommandHandler("refresh", refresh))
         application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
         
+        # Load the sheet now, then keep it fresh in the background
+        bot.schedule_refresh(application.job_queue)
+        
         # Start the bot
         logger.info("Starting Telegram bot...")
         print("Starting Telegram bot...")
         print("Bot is running! Send /start to your bot to test it.")
-        application.run_polling(allowed_updates=Update.ALL_TYPES)
+        run_bot(application, bot.bot_token)
         
     except Exception as e:
         logger.error(f"Failed to start bot: {e}")
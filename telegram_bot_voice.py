@@ -1,19 +1,17 @@
 import os
+import asyncio
 import logging
+import threading
 from telegram import Update, Voice
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
-import pandas as pd
 from dotenv import load_dotenv
-import json
-import pickle
+from sheets_backend import SheetsBackend
+from telegram_utils import run_bot, safe_reply, telegram_limiter
 import speech_recognition as sr
 import pyttsx3
 import tempfile
 import requests
+import base64
 from io import BytesIO
 
 # Load environment variables
@@ -26,143 +24,35 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-class TelegramBotWithSheetsAndVoice:
+# Google Cloud Speech-to-Text REST endpoint
+SPEECH_API_URL = 'https://speech.googleapis.com/v1/speech:recognize'
+
+class TelegramBotWithSheetsAndVoice(SheetsBackend):
     def __init__(self):
+        super().__init__()
         self.bot_token = os.getenv('TELEGRAM_BOT_TOKEN')
-        self.spreadsheet_id = os.getenv('GOOGLE_SHEET_ID')
-        self.scopes = ['https://www.googleapis.com/auth/spreadsheets.readonly']
-        self.credentials = None
-        self.service = None
         
         # Initialize speech recognition and text-to-speech
         self.recognizer = sr.Recognizer()
+        self.speech_api_key = os.getenv('GOOGLE_SPEECH_API_KEY')
+        # One keep-alive session for every Cloud Speech request
+        self._speech_session = requests.Session()
         self.tts_engine = pyttsx3.init()
+        self._tts_lock = threading.Lock()
         
         # Configure TTS voice
         voices = self.tts_engine.getProperty('voices')
         if voices:
             self.tts_engine.setProperty('voice', voices[0].id)  # Use first available voice
         self.tts_engine.setProperty('rate', 150)  # Speed of speech
-        
-    def authenticate_google_sheets(self):
-        """Authenticate with Google Sheets API"""
-        try:
-            creds = None
-            if os.path.exists('token.pickle'):
-                with open('token.pickle', 'rb') as token:
-                    creds = pickle.load(token)
-            
-            if not creds or not creds.valid:
-                if creds and creds.expired and creds.refresh_token:
-                    creds.refresh(Request())
-                else:
-                    if not os.path.exists('credentials.json'):
-                        raise FileNotFoundError("credentials.json not found. Please download it from Google Cloud Console.")
-                    
-                    flow = InstalledAppFlow.from_client_secrets_file(
-                        'credentials.json', self.scopes)
-                    creds = flow.run_local_server(port=8080, open_browser=True)
-                
-                with open('token.pickle', 'wb') as token:
-                    pickle.dump(creds, token)
-            
-            self.credentials = creds
-            self.service = build('sheets', 'v4', credentials=creds)
-            logger.info("Google Sheets authentication successful")
-        except Exception as e:
-            logger.error(f"Google Sheets authentication failed: {e}")
-            raise
     
-    def get_sheet_data(self, sheet_name='Sheet1', range_name=None):
-        """Retrieve data from Google Sheets"""
+    def speech_to_text(self, voice_data):
+        """Convert a Telegram voice note (OGG/Opus bytes) to text"""
         try:
-            if not self.service:
-                self.authenticate_google_sheets()
-            
-            if range_name is None:
-                range_name = f'{sheet_name}!A:Z'
+            if self.speech_api_key:
+                return self._recognize_cloud(voice_data)
             
-            sheet = self.service.spreadsheets()
-            result = sheet.values().get(
-                spreadsheetId=self.spreadsheet_id,
-                range=range_name
-            ).execute()
-            
-            values = result.get('values', [])
-            
-            if not values:
-                logger.warning('No data found in the sheet')
-                return pd.DataFrame()
-            
-            df = pd.DataFrame(values[1:], columns=values[0])
-            logger.info(f"Retrieved {len(df)} rows from Google Sheets")
-            return df
-            
-        except Exception as e:
-            logger.error(f"Error retrieving data from Google Sheets: {e}")
-            return pd.DataFrame()
-    
-    def search_data(self, query, df):
-        """Search for data based on query"""
-        if df.empty:
-            return "No data available"
-        
-        df_str = df.astype(str)
-        mask = df_str.apply(lambda x: x.str.contains(query, case=False, na=False)).any(axis=1)
-        results = df[mask]
-        
-        if results.empty:
-            return f"No results found for '{query}'"
-        
-        if len(results) == 1:
-            return self.format_single_result(results.iloc[0])
-        else:
-            return self.format_multiple_results(results)
-    
-    def format_single_result(self, row):
-        """Format a single result row"""
-        result = "Found Result:\n\n"
-        for col, value in row.items():
-            if pd.notna(value) and str(value).strip():
-                result += f"{col}: {value}\n"
-        return result
-    
-    def format_multiple_results(self, results):
-        """Format multiple results"""
-        result = f"Found {len(results)} results:\n\n"
-        
-        for i, (_, row) in enumerate(results.head(5).iterrows()):
-            result += f"Result {i+1}:\n"
-            for col, value in row.items():
-                if pd.notna(value) and str(value).strip():
-                    result += f"  {col}: {value}\n"
-            result += "\n"
-        
-        if len(results) > 5:
-            result += f"... and {len(results) - 5} more results"
-        
-        return result
-    
-    def get_summary_stats(self, df):
-        """Get summary statistics of the data"""
-        if df.empty:
-            return "No data available for summary"
-        
-        summary = "Data Summary:\n\n"
-        summary += f"Total Records: {len(df)}\n"
-        summary += f"Total Columns: {len(df.columns)}\n\n"
-        
-        summary += "Columns:\n"
-        for col in df.columns:
-            non_null_count = df[col].notna().sum()
-            summary += f"  • {col} ({non_null_count} values)\n"
-        
-        return summary
-    
-    def speech_to_text(self, voice_file_path):
-        """Convert speech to text"""
-        try:
-            with sr.AudioFile(voice_file_path) as source:
+            with sr.AudioFile(BytesIO(voice_data)) as source:
                 audio = self.recognizer.record(source)
             
             text = self.recognizer.recognize_google(audio)
@@ -170,12 +60,42 @@ class TelegramBotWithSheetsAndVoice:
             return text
         except sr.UnknownValueError:
             return "Sorry, I couldn't understand the audio."
-        except sr.RequestError as e:
-            return f"Speech recognition service error: {e}"
+        except (sr.RequestError, requests.RequestException) as e:
+            # Error text can carry request URLs and details; keep it in the log.
+            # A "Sorry" reply stops the handler from searching the sheet for it
+            logger.error(f"Speech recognition service error: {e}")
+            return "Sorry, I couldn't transcribe that voice message. Please try again or type your question."
         except Exception as e:
             logger.error(f"Speech to text error: {e}")
             return "Sorry, there was an error processing your voice message."
     
+    def _recognize_cloud(self, voice_data):
+        """Transcribe OGG/Opus audio with Cloud Speech-to-Text, no local decoding"""
+        response = self._speech_session.post(
+            SPEECH_API_URL,
+            # In a header, not the query string, so the key never shows up in error URLs
+            headers={'X-Goog-Api-Key': self.speech_api_key},
+            json={
+                'config': {
+                    'encoding': 'OGG_OPUS',
+                    'sampleRateHertz': 48000,
+                    'languageCode': 'en-US'
+                },
+                'audio': {'content': base64.b64encode(voice_data).decode('ascii')}
+            },
+            timeout=30
+        )
+        response.raise_for_status()
+        
+        transcripts = [result['alternatives'][0]['transcript']
+                       for result in response.json().get('results', [])
+                       if result.get('alternatives')]
+        text = ' '.join(transcripts).strip()
+        if not text:
+            return "Sorry, I couldn't understand the audio."
+        logger.info(f"Speech to text: {text}")
+        return text
+    
     def text_to_speech(self, text):
         """Convert text to speech and return audio file path"""
         try:
@@ -183,9 +103,10 @@ class TelegramBotWithSheetsAndVoice:
             temp_file = tempfile.NamedTemporaryFile(delete=False, suffix='.wav')
             temp_file.close()
             
-            # Save speech to file
-            self.tts_engine.save_to_file(text, temp_file.name)
-            self.tts_engine.runAndWait()
+            # Save speech to file; the pyttsx3 engine is not thread-safe
+            with self._tts_lock:
+                self.tts_engine.save_to_file(text, temp_file.name)
+                self.tts_engine.runAndWait()
             
             return temp_file.name
         except Exception as e:
@@ -195,6 +116,28 @@ class TelegramBotWithSheetsAndVoice:
 # Initialize bot
 bot = TelegramBotWithSheetsAndVoice()
 
+async def reply_with_voice(update: Update, text):
+    """Reply with text and a spoken copy, synthesizing while the text is sent"""
+    voice_file, sent = await asyncio.gather(
+        asyncio.to_thread(bot.text_to_speech, text),
+        safe_reply(update, text),
+        return_exceptions=True
+    )
+    # A failed synthesis only costs the voice copy; the text reply still counts
+    if isinstance(voice_file, BaseException):
+        logger.error(f"Text to speech error: {voice_file}")
+        voice_file = None
+    try:
+        if isinstance(sent, BaseException):
+            raise sent
+        if voice_file:
+            with open(voice_file, 'rb') as audio:
+                async with telegram_limiter:
+                    await update.message.reply_voice(voice=audio)
+    finally:
+        if voice_file:
+            os.unlink(voice_file)  # Clean up temp file
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Send a message when the command /start is issued."""
     welcome_message = """
@@ -221,7 +164,7 @@ How to use:
 
 Example: Send a voice message saying "Find all products with price greater than 100"
     """
-    await update.message.reply_text(welcome_message)
+    await safe_reply(update, welcome_message)
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Send a message when the command /help is issued."""
@@ -250,70 +193,55 @@ Tips:
 • Speak clearly for best recognition
 • You can ask questions in natural language
 • Search is case-insensitive
+• Join terms with AND to find rows containing all of them
 • I'll show you the most relevant results
     """
-    await update.message.reply_text(help_text)
+    await safe_reply(update, help_text)
 
 async def summary(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Get summary of the data"""
     try:
-        df = bot.get_sheet_data()
+        df = await bot.aget_sheet_data()
         summary_text = bot.get_summary_stats(df)
-        await update.message.reply_text(summary_text)
-        
-        # Also send voice response
-        voice_file = bot.text_to_speech(summary_text)
-        if voice_file:
-            await update.message.reply_voice(voice=open(voice_file, 'rb'))
-            os.unlink(voice_file)  # Clean up temp file
+        # Send text and voice response
+        await reply_with_voice(update, summary_text)
             
     except Exception as e:
         error_msg = f"Error getting summary: {str(e)}"
-        await update.message.reply_text(error_msg)
+        await safe_reply(update, error_msg)
 
 async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /search command"""
     try:
         query = ' '.join(context.args) if context.args else ""
         if not query:
-            await update.message.reply_text("Please provide a search query. Example: /search products")
+            await safe_reply(update, "Please provide a search query. Example: /search products")
             return
         
-        df = bot.get_sheet_data()
-        results = bot.search_data(query, df)
-        await update.message.reply_text(results)
-        
-        # Also send voice response
-        voice_file = bot.text_to_speech(results)
-        if voice_file:
-            await update.message.reply_voice(voice=open(voice_file, 'rb'))
-            os.unlink(voice_file)  # Clean up temp file
+        df = await bot.aget_sheet_data()
+        results = await asyncio.to_thread(bot.search_data, query, df)
+        # Send text and voice response
+        await reply_with_voice(update, results)
             
     except Exception as e:
         error_msg = f"Error searching: {str(e)}"
-        await update.message.reply_text(error_msg)
+        await safe_reply(update, error_msg)
 
 async def refresh(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Refresh data from Google Sheets"""
     try:
-        if os.path.exists('token.pickle'):
-            os.remove('token.pickle')
-        
-        bot.authenticate_google_sheets()
-        df = bot.get_sheet_data()
+        # Drop the cached sheet; renew the access token only if it has expired
+        bot.clear_cache()
+        await asyncio.to_thread(bot.refresh_credentials)
+        df = await bot.aget_sheet_data()
         
         success_msg = f"Data refreshed! Retrieved {len(df)} records from Google Sheets."
-        await update.message.reply_text(success_msg)
-        
-        # Also send voice response
-        voice_file = bot.text_to_speech(success_msg)
-        if voice_file:
-            await update.message.reply_voice(voice=open(voice_file, 'rb'))
-            os.unlink(voice_file)  # Clean up temp file
+        # Send text and voice response
+        await reply_with_voice(update, success_msg)
             
     except Exception as e:
         error_msg = f"Error refreshing data: {str(e)}"
-        await update.message.reply_text(error_msg)
+        await safe_reply(update, error_msg)
 
 async def handle_voice_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle voice messages"""
@@ -324,43 +252,34 @@ async def handle_voice_message(update: Update, context: ContextTypes.DEFAULT_TYP
         # Download voice file
         voice_file = await context.bot.get_file(voice.file_id)
         
-        # Save to temporary file
-        temp_file = tempfile.NamedTemporaryFile(delete=False, suffix='.ogg')
-        await voice_file.download_to_drive(temp_file.name)
+        # Keep the download in memory; Telegram voice notes are already OGG/Opus
+        voice_data = BytesIO()
+        await voice_file.download_to_memory(voice_data)
         
         # Convert speech to text
-        user_query = bot.speech_to_text(temp_file.name)
-        
-        # Clean up temp file
-        os.unlink(temp_file.name)
+        user_query = await asyncio.to_thread(bot.speech_to_text, voice_data.getvalue())
         
         if user_query.startswith("Sorry"):
-            await update.message.reply_text(user_query)
+            await safe_reply(update, user_query)
             return
         
         # Process the query
-        await update.message.reply_text(f"🎤 I heard: {user_query}")
+        await safe_reply(update, f"🎤 I heard: {user_query}")
         
         # Get data from Google Sheets
-        df = bot.get_sheet_data()
+        df = await bot.aget_sheet_data()
         
         if df.empty:
             response = "No data available. Please check your Google Sheets configuration."
         else:
-            response = bot.search_data(user_query, df)
+            response = await asyncio.to_thread(bot.search_data, user_query, df)
         
-        # Send text response
-        await update.message.reply_text(response)
-        
-        # Send voice response
-        voice_file = bot.text_to_speech(response)
-        if voice_file:
-            await update.message.reply_voice(voice=open(voice_file, 'rb'))
-            os.unlink(voice_file)  # Clean up temp file
+        # Send text and voice response
+        await reply_with_voice(update, response)
         
     except Exception as e:
         logger.error(f"Error handling voice message: {e}")
-        await update.message.reply_text(f"Sorry, I encountered an error processing your voice message: {str(e)}")
+        await safe_reply(update, "Sorry, I encountered an error processing your voice message.")
 
 async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle regular text messages"""
@@ -369,25 +288,20 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
         logger.info(f"User query: {user_message}")
         
         # Get data from Google Sheets
-        df = bot.get_sheet_data()
+        df = await bot.aget_sheet_data()
         
         if df.empty:
-            await update.message.reply_text("No data available. Please check your Google Sheets configuration.")
+            await safe_reply(update, "No data available. Please check your Google Sheets configuration.")
             return
         
         # Search for the query
-        results = bot.search_data(user_message, df)
-        await update.message.reply_text(results)
-        
-        # Also send voice response
-        voice_file = bot.text_to_speech(results)
-        if voice_file:
-            await update.message.reply_voice(voice=open(voice_file, 'rb'))
-            os.unlink(voice_file)  # Clean up temp file
+        results = await asyncio.to_thread(bot.search_data, user_message, df)
+        # Send text and voice response
+        await reply_with_voice(update, results)
         
     except Exception as e:
         logger.error(f"Error handling message: {e}")
-        await update.message.reply_text(f"Sorry, I encountered an error: {str(e)}")
+        await safe_reply(update, f"Sorry, I encountered an error: {str(e)}")
 
 def main():
     """Start the bot."""
@@ -405,7 +319,14 @@ def main():
             return
         
         # Create the Application
-        application = Application.builder().token(bot.bot_token).build()
+        # One aiohttp session serves every Sheets read for the life of the bot
+        application = (
+            Application.builder()
+            .token(bot.bot_token)
+            .post_init(lambda application: bot.open_session())
+            .post_shutdown(lambda application: bot.close_session())
+            .build()
+        )
         
         # Add handlers
         application.add_handler(CommandHandler("start", start))
@@ -420,12 +341,15 @@ def main():
         # Add text message handler
         application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_message))
         
+        # Load the sheet now, then keep it fresh in the background
+        bot.schedule_refresh(application.job_queue)
+        
         # Start the bot
         logger.info("Starting Voice-Enabled Telegram bot...")
         print("🎤 Starting Voice-Enabled Telegram bot...")
         print("✅ Bot is running! Send /start to your bot to test it.")
         print("🎤 You can now send voice messages!")
-        application.run_polling(allowed_updates=Update.ALL_TYPES)
+        run_bot(application, bot.bot_token)
         
     except Exception as e:
         logger.error(f"Failed to start bot: {e}")
@@ -0,0 +1,116 @@
+"""
+Reply and startup helpers shared by the Telegram bots
+"""
+
+import os
+from aiolimiter import AsyncLimiter
+from telegram import Update
+from telegram.error import BadRequest, NetworkError, RetryAfter, TimedOut
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_random_exponential
+
+# Telegram rejects messages over 4096 UTF-16 code units; stay a little under
+MESSAGE_LIMIT = 4000
+
+# Shared by every send so bursts stay under Telegram's flood limits
+telegram_limiter = AsyncLimiter(20, 1)
+
+def _utf16_len(text):
+    """Length as Telegram counts it, in UTF-16 code units: most emoji count twice"""
+    return len(text.encode('utf-16-le')) // 2
+
+def split_message(text, limit=MESSAGE_LIMIT, separators=('\n\n', '\n')):
+    """Split text into pieces Telegram accepts, breaking at paragraphs, then lines"""
+    # Telegram rejects a message that is empty or only whitespace
+    return [chunk for chunk in _split(text, limit, separators) if chunk.strip()]
+
+def _split(text, limit, separators):
+    """Split text at the first separator, falling back to the next for parts still too long"""
+    if _utf16_len(text) <= limit:
+        return [text]
+    if not separators:
+        return _hard_split(text, limit)
+    
+    separator = separators[0]
+    separator_len = _utf16_len(separator)
+    chunks = []
+    current = ''
+    current_len = 0
+    for part in text.split(separator):
+        part_len = _utf16_len(part)
+        candidate_len = current_len + separator_len + part_len if current else part_len
+        if candidate_len <= limit:
+            current = f"{current}{separator}{part}" if current else part
+            current_len = candidate_len
+            continue
+        
+        if current:
+            chunks.append(current)
+        # A part that is too long on its own falls back to the next separator
+        pieces = _split(part, limit, separators[1:])
+        chunks.extend(pieces[:-1])
+        current = pieces[-1]
+        current_len = _utf16_len(current)
+    
+    if current:
+        chunks.append(current)
+    return chunks
+
+def _hard_split(text, limit):
+    """Cut text into pieces of at most limit UTF-16 units, never inside a character"""
+    chunks = []
+    start = 0
+    size = 0
+    for i, char in enumerate(text):
+        width = 2 if ord(char) > 0xFFFF else 1
+        if size + width > limit:
+            chunks.append(text[start:i])
+            start = i
+            size = 0
+        size += width
+    chunks.append(text[start:])
+    return chunks
+
+def _should_resend(error):
+    """Flood control and failed connections are retried; rejected messages are not"""
+    # A timeout does not mean the message was lost, so resending could post it twice
+    if isinstance(error, (BadRequest, TimedOut)):
+        return False
+    return isinstance(error, (RetryAfter, NetworkError))
+
+_backoff = wait_random_exponential(multiplier=0.3, max=5)
+
+def _resend_wait(retry_state):
+    """Wait as long as Telegram asks after flood control, else back off with jitter"""
+    error = retry_state.outcome.exception()
+    if isinstance(error, RetryAfter):
+        return error.retry_after
+    return _backoff(retry_state)
+
+@retry(retry=retry_if_exception(_should_resend), stop=stop_after_attempt(4),
+       wait=_resend_wait, reraise=True)
+async def _send_text(message, text):
+    """Send one message through the shared rate limiter"""
+    async with telegram_limiter:
+        await message.reply_text(text)
+
+async def safe_reply(update, text):
+    """Reply with text, split to Telegram's size limit, paced and retried"""
+    for chunk in split_message(text):
+        await _send_text(update.message, chunk)
+
+def run_bot(application, bot_token):
+    """Serve updates over a webhook when WEBHOOK_URL is set, else by long polling"""
+    # Commands, text and voice all arrive as plain message updates
+    webhook_url = os.getenv('WEBHOOK_URL')
+    if webhook_url:
+        # The token as URL path keeps the endpoint unguessable
+        application.run_webhook(
+            listen='0.0.0.0',
+            port=int(os.getenv('PORT', 8443)),
+            url_path=bot_token,
+            webhook_url=f"{webhook_url.rstrip('/')}/{bot_token}",
+            secret_token=os.getenv('TG_SECRET') or None,
+            allowed_updates=[Update.MESSAGE]
+        )
+    else:
+        application.run_polling(allowed_updates=[Update.MESSAGE], timeout=30)